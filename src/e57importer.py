@@ -28,8 +28,42 @@
 # http://www.libe57.org
 # http://paulbourke.net/dataformats/e57/
 
+import io
+import mmap
+import os
+import struct
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
+
 import numpy as np
 
+try:
+    from numba import njit, prange
+    E57_NUMBA = True
+except ImportError:
+    # numba is optional, without it the kernels run as plain python
+    E57_NUMBA = False
+    prange = range
+    def njit(*args, **kwargs):
+        if (len(args)==1 and callable(args[0])):
+            return args[0]
+        return lambda func: func
+
+try:
+    # the xml part is parsed in c with lxml, if it is installed
+    from lxml import etree as ET
+    E57_LXML = True
+except ImportError:
+    import xml.etree.ElementTree as ET
+    E57_LXML = False
+
+try:
+    # hardware accelerated crc-32c (sse4.2 / armv8 crc instructions)
+    from crc32c import crc32c
+except ImportError:
+    crc32c = None
+
 
 E57_DEBUG        = True
 
@@ -41,26 +75,111 @@ E57_INDEX_PACKET = 0
 E57_DATA_PACKET  = 1
 E57_EMPTY_PACKET = 2 
 E57_DATA_PACKET_MAX = (64*E57_STD_PAGE_SIZE)
+E57_CRC_POLYNOMIAL  = 0x82F63B78    # crc-32c, reflected
+E57_CHECK_PAGES     = 1024          # pages per block of a full file check
+E57_SPECIALIZE      = 1 << 26       # values of one width decoded in the
+                                    # process from which a kernel compiled
+                                    # for the width pays off its compile
+E57_INT64_MIN = -2**63
+E57_INT64_MAX = 2**63 - 1
+# decoded ScaledInteger values (coordinates), E57 quantization rarely
+# needs more than the 24 bit mantissa of a float
+E57_SCALED_TYPE = np.float32
+
+# tags in clark notation, the parser matches them without a lookup of
+# the prefix in a namespace map
+_TAG_E57       = '{%s}' % E57_NS['e57']
+_TAG_POINTS    = _TAG_E57 + 'points'
+_TAG_PROTOTYPE = _TAG_E57 + 'prototype'
+
+# packed widths that are plain little endian integers
+_ALIGNED_TYPES = {8: np.uint8, 16: np.uint16, 32: np.uint32, 64: np.uint64}
+
+# candidates for the decoded type of Integer fields, narrowest first
+_UNSIGNED_TYPES = (np.uint8, np.uint16, np.uint32, np.uint64)
+_SIGNED_TYPES   = (np.int8, np.int16, np.int32, np.int64)
+
+# a point cloud as listScans reports it, all of it comes from the xml
+E57Scan = namedtuple('E57Scan', 'prototype fileOffset recordCount')
+
+# a prototype field as decodeField needs it: the decoded type, the packed
+# width in bits and the numbers of the xml attributes
+FieldSpec = namedtuple('FieldSpec', 
+                       'name kind dtype bits minimum maximum scale offset')
+
+# the file header and the start all packet types share, unpacked with
+# struct where only python ints are wanted
+_HEADER_ST = struct.Struct('<8sIIQQQQ')
+_PACKET_ST = struct.Struct('<BxH')
+
+# record layouts of the binary structures, built once at import
+_CVSH_DT   = np.dtype([ ('sectionId', np.uint8),
+                        ('reserved1', np.uint8, (7,)),
+                        ('sectionLogicalLength', np.uint64),
+                        ('dataPhysicalOffset', np.uint64),
+                        ('indexPhysicalOffset', np.uint64) ])
+
+_DPH_DT    = np.dtype([ ('packetType', np.uint8),
+                        ('packetFlags', np.uint8),
+                        ('packetLogicalLengthMinus1', np.uint16),
+                        ('bytestreamCount', np.uint16) ])
+
+_IPH_DT    = np.dtype([ ('packetType', np.uint8),
+                        ('packetFlags', np.uint8),
+                        ('packetLogicalLengthMinus1', np.uint16),
+                        ('entryCount', np.uint16),
+                        ('indexLevel', np.uint8),
+                        ('reserved1', np.uint8, (9,)) ])
 
 class E57:
 
     def __init__(self, filename, checkfile=True): 
         self.filename  = filename
         self.checkfile = checkfile 
-        self.readHeader()
-        self.buildRoot()
+        # open and map the file once, all segment reads are slices of
+        # this map
+        self._fh  = open(filename, 'rb')
+        self._map = None
+        try:
+            self._map = mmap.mmap(self._fh.fileno(), 0, 
+                                  access=mmap.ACCESS_READ)
+            self._mm  = np.frombuffer(self._map, dtype=np.uint8)
+            self.readHeader()
+        except:
+            # a file that can not be read is not kept open
+            self.close()
+            raise
+        
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, *args):
+        self.close()
+        
+    def close(self):
+        self._mm = None
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # views of the map are still alive, it is released with 
+                # them
+                pass
+        self._fh.close()
         
     def readHeader(self):
-        header = E57Header(self.filename)
-        self.fileSignature      = header['fileSignature'].decode()
-        self.majorVersion       = header['majorVersion']
-        self.minorVersion       = header['minorVersion']
-        self.filePhysicalLength = header['filePhysicalLength']
-        self.xmlPhysicalOffset  = header['xmlPhysicalOffset']
-        self.xmlLogicalLength   = header['xmlLogicalLength']
-        self.pageSize           = header['pageSize']
-        self.pageContent        = (self.pageSize 
-                                    - E57_PAGE_CRC).astype(np.uint64)
+        if (len(self._map) < _HEADER_ST.size):
+            raise ValueError('No E57 file format.')
+        # unpacked straight from the map into python ints
+        (fileSignature,
+         self.majorVersion,
+         self.minorVersion,
+         self.filePhysicalLength,
+         self.xmlPhysicalOffset,
+         self.xmlLogicalLength,
+         self.pageSize)         = _HEADER_ST.unpack_from(self._map, 0)
+        self.fileSignature      = fileSignature.decode()
+        self.pageContent        = self.pageSize - E57_PAGE_CRC
                                     
         # set page size from segment reader
         SegmentReader.setPageSize(self.pageSize)
@@ -72,95 +191,455 @@ class E57:
             # check file size
             if not ( (self.filePhysicalLength % self.pageSize) == 0):
                 raise ValueError('File size is not compliant.')
+            # check the page of the header
+            SegmentReader.checkPages(self._mm, 0, 1)
     
+    def checkPages(self, chunk=E57_CHECK_PAGES):
+        # verify the crc of every page of the file, chunk pages at a time;
+        # with checkfile the pages are already verified as they are read
+        pages = self.filePhysicalLength // self.pageSize
+        for start in range(0, pages, chunk):
+            SegmentReader.checkPages(self._mm, start, min(start+chunk, pages))
+        return True
+        
+    def readXML(self):
+        return E57XMLReader(self._mm, 
+                            self.xmlPhysicalOffset,
+                            self.xmlLogicalLength,
+                            check=self.checkfile)
+        
     def extractXML(self):
-        return SegmentReader(self.filename, 
-                             self.xmlPhysicalOffset,
-                             self.xmlLogicalLength).toXML()
+        # the raw utf-8 bytes, the parsers take them without a decode
+        return self.readXML().toBytes()
+        
+    @cached_property
+    def root(self):
+        # the xml is only extracted and parsed on first use, reading the
+        # header data needs none of it
+        return self.buildRoot()
         
     def buildRoot(self):
-        import xml.etree.ElementTree as ET
-        xmltxt = self.extractXML()
-        #print(xmltxt)
-        self.root = ET.fromstring(xmltxt) 
+        return ET.fromstring(self.extractXML())
         
     def findElement(self, name, parent=None):
         if (parent is None):
             parent = self.root
-        return parent.find('e57:'+name, E57_NS)
+        return parent.find(_TAG_E57+name)
         
     def iterElements(self, name, parent=None):
         if (parent is None):
             parent = self.root
-        return parent.iterfind('.//e57:'+name, E57_NS)      
+        return parent.iterfind('.//'+_TAG_E57+name)
  
     def readCompressedVectorSectionHeader(self, offset):
-        return E57CompressedVectorSectionHeader(self.filename, offset)   
+        return E57CompressedVectorSectionHeader(self._mm, offset,
+                                                check=self.checkfile)   
         
     def readDataPacketHeader(self, offset):
-        return E57DataPacketHeader(self.filename, offset)   
+        return E57DataPacketHeader(self._mm, offset, 
+                                   check=self.checkfile)   
 
     def readIndexPacketHeader(self, offset):
-        return E57IndexPacketHeader(self.filename, offset)                       
+        return E57IndexPacketHeader(self._mm, offset, 
+                                    check=self.checkfile)                       
+        
+    def readSection(self, pos):
+        # logical content of a whole CompressedVector section in one 
+        # gather (crcs are checked once per page), and the logical 
+        # offset of its first packet within it
+        cv = self.readCompressedVectorSectionHeader(pos)
+        section = SegmentReader(self._mm, pos, 
+                                int(cv['sectionLogicalLength']),
+                                check=self.checkfile).result.view(np.uint8)
+        first = int(cv['dataPhysicalOffset'])
+        if (first>0):
+            first = (SegmentReader.logicalOffset(first) 
+                     - SegmentReader.logicalOffset(pos))
+        return section, first
+        
+    def packetOffsets(self, section, first):
+        # offsets of the data packets within the section content, only 
+        # the four header bytes all packet types share are touched
+        offset = first
+        offsets = []
+        while (offset>0) and (offset < len(section)):
+            packetType, lengthMinus1 = _PACKET_ST.unpack_from(section, 
+                                                              offset)
+            if (packetType==E57_DATA_PACKET):
+                offsets.append(offset)
+            offset += lengthMinus1 + 1
+        return np.array(offsets, dtype=np.int64)
+        
+    def bufferTable(self, section, offsets, count):
+        # (packets, count) start and length of every bytestream buffer: 
+        # the header, one uint16 length per bytestream, then the buffers
+        headers = section[offsets[:, None] 
+                          + np.arange(_DPH_DT.itemsize)].view(_DPH_DT)
+        streams = headers['bytestreamCount'].ravel()
+        # libE57 writes an empty scan as one packet without bytestreams,
+        # only packets which carry streams have to match the prototype
+        offsets = offsets[streams!=0]
+        if not np.all(streams[streams!=0]==count):
+            raise ValueError('Bytestream count does not match prototype.')
+        index = (offsets[:, None] + _DPH_DT.itemsize 
+                 + 2 * np.arange(count))
+        lengths = (section[index].astype(np.int64) 
+                   | (section[index+1].astype(np.int64) << 8))
+        starts = np.cumsum(lengths, axis=1) - lengths
+        starts += (offsets + _DPH_DT.itemsize + 2 * count)[:, None]
+        return starts, lengths
+        
+    def readBytestreams(self, pos, count):
+        # every bytestream of the section joined over all packets; the 
+        # buffers of all packets are copied in parallel, each packet 
+        # into its own slice of the stream
+        section, first = self.readSection(pos)
+        offsets = self.packetOffsets(section, first)
+        starts, lengths = self.bufferTable(section, offsets, count)
+        targets = np.cumsum(lengths, axis=0) - lengths
+        streams = []
+        for i in range(count):
+            stream = np.empty(int(lengths[:, i].sum()), np.uint8)
+            streams.append(gatherBuffers(section, starts[:, i], lengths[:, i],
+                                         targets[:, i], stream))
+        return streams
         
     def bitsNeeded(self, maximum, minimum):
-        # like the c variant
-        log2 = 0
-        state = maximum - minimum
-        if ((0xFFFFFFFF00000000 & state)>0):
-            state = state >> 32
-            log2+= 32
-        if((0xFFFF0000 & state)>0):
-            state = state >> 16
-            log+= 16
-        if((0x0FF00 & state)>0):
-            state = state >> 8
-            log2+= 8   
-        if((0xF0 & state)>0):
-            state = state >> 4
-            log2+= 4       
-        if((0xC & state)>0):
-            state = state >> 2
-            log2+= 2   
-        if((0x2 & state)>0):
-            state = state >> 1
-            log2+= 1     
-        if((0x1 & state)>0):
-            log2+= 1 
-        return log2
-        
-    def extractCompressedVector(self):
-        data = self.findElement('data3D')
-        for pts in self.iterElements('points'):
-            if (pts.attrib['type']=='CompressedVector'):
-                pos = int(pts.attrib['fileOffset'])
-                cnt = int(pts.attrib['recordCount'])
-                
-                proto = self.findElement('prototype', pts)
-                cx = self.findElement('cartesianX', proto)
-                
-                fx = np.array([cx.attrib['minimum'], cx.attrib['maximum']],
-                                dtype=np.float)
-                print('minimum',cx.attrib['minimum'])
-                print('maximum',cx.attrib['maximum'])
-        
-                  
-                cv = self.readCompressedVectorSectionHeader(pos)
-                dh = self.readDataPacketHeader(cv['dataPhysicalOffset'])
-                
-                offset = cv['dataPhysicalOffset']
-                offset += dh['packetLogicalLengthMinus1']             
-                idx = self.readIndexPacketHeader(offset)
-        
-                print(pos)
-                print(cnt)
-                print('sectionLogicalLength: ', cv['sectionLogicalLength'])
-                print('filePhysicalLength: ',self.filePhysicalLength)
-                print('dataPhysicalOffset', cv['dataPhysicalOffset'])
-                print('packetLogicalLengthMinus1', 
-                        dh['packetLogicalLengthMinus1'])
-                print('bytestreamCount', dh['bytestreamCount'])
+        # bits of one packed value, like the c variant: ceil(log2(range+1))
+        return (int(maximum) - int(minimum)).bit_length()
+        
+    def integerType(self, maximum, minimum):
+        # narrowest integer type holding all values of a field, colors
+        # and intensities stay uint8/uint16 instead of int64
+        types = _UNSIGNED_TYPES if (minimum >= 0) else _SIGNED_TYPES
+        for t in types:
+            info = np.iinfo(t)
+            if (info.min <= minimum and maximum <= info.max):
+                return np.dtype(t)
+        return np.dtype(np.int64)
+        
+    def fieldSpec(self, field, dtype=E57_SCALED_TYPE):
+        # the attributes of a prototype field as numbers, parsed once per
+        # scan; dtype is the type ScaledInteger values are dequantized to
+        name = field.tag.split('}')[-1]
+        kind = field.attrib['type']
+        if (kind=='Float'):
+            if (field.attrib.get('precision', 'double')=='single'):
+                return FieldSpec(name, kind, np.dtype(np.float32), 32, 
+                                 0, 0, 1.0, 0.0)
+            return FieldSpec(name, kind, np.dtype(np.float64), 64, 
+                             0, 0, 1.0, 0.0)
+        minimum = int(field.attrib.get('minimum', E57_INT64_MIN))
+        maximum = int(field.attrib.get('maximum', E57_INT64_MAX))
+        scale   = float(field.attrib.get('scale', 1.0))
+        offset  = float(field.attrib.get('offset', 0.0))
+        if (kind=='ScaledInteger'):
+            decoded = np.dtype(dtype)
+        else:
+            decoded = self.integerType(maximum, minimum)
+        return FieldSpec(name, kind, decoded, 
+                         self.bitsNeeded(maximum, minimum),
+                         minimum, maximum, scale, offset)
+        
+    def parsePrototype(self, proto, dtype=E57_SCALED_TYPE):
+        return [self.fieldSpec(field, dtype) for field in proto]
+        
+    def decodeField(self, spec, stream, count, out=None):
+        # values of one prototype field (a FieldSpec) from its joined 
+        # bytestream, written into out if it is given
+        if out is None:
+            out = np.empty(count, spec.dtype)
+        kind, bits = spec.kind, spec.bits
+        minimum, scale, offset = spec.minimum, spec.scale, spec.offset
+        if (kind=='Float'):
+            out[:] = np.frombuffer(stream, out.dtype, count)
+            return out
+        if (bits==0):
+            # only one possible value, nothing is stored
+            out[:] = (minimum * scale + offset 
+                      if (kind=='ScaledInteger') else minimum)
+            return out
+        if (len(stream) * 8 < count * bits):
+            # the kernels do not check bounds, a recordCount beyond the
+            # stored values would read past the stream
+            raise ValueError('Bytestream is shorter than recordCount.')
+        if (bits in _ALIGNED_TYPES):
+            # byte aligned widths need no shifts at all, view the stream
+            raw = np.frombuffer(stream, _ALIGNED_TYPES[bits], count)
+            if (kind=='ScaledInteger'):
+                out[:] = (raw.astype(np.int64) + minimum) * scale + offset
+                return out
+            out[:] = raw
+            out += minimum
+            return out
+        # the kernels read whole words, pad the end of the stream
+        packed = np.concatenate((stream, np.zeros(8, np.uint8)))
+        if (kind=='ScaledInteger'):
+            return unpackScaled(packed, bits, count, minimum, scale, offset,
+                                out)
+        # the offset values are stored truncated to the type of out, with
+        # the minimum added they wrap back into the range of the field
+        unpackBits(packed, bits, count, out)
+        out += minimum
+        return out
+        
+    def iterScans(self):
+        # an E57Scan (prototype, fileOffset, recordCount) of every
+        # CompressedVector points node, streamed from the xml without
+        # building the tree; only the prototypes are kept, everything
+        # else is cleared as soon as it is parsed
+        inside = False
+        source = io.BytesIO(self.extractXML())
+        for event, elem in ET.iterparse(source, events=('start', 'end')):
+            if (elem.tag==_TAG_POINTS 
+                and elem.get('type')=='CompressedVector'):
+                inside = (event=='start')
+                if inside:
+                    continue
+                proto = elem.find(_TAG_PROTOTYPE)
+                elem.remove(proto)
+                yield E57Scan(proto, int(elem.get('fileOffset')), 
+                              int(elem.get('recordCount')))
+            elif (inside or event=='start'):
+                continue
+            elem.clear()
+            if E57_LXML:
+                # lxml keeps the cleared elements in the tree, drop them
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+        
+    def listScans(self):
+        # the point clouds of the file without reading any point data,
+        # decode the ones needed with loadScan
+        return list(self.iterScans())
+        
+    def readScan(self, proto, pos):
+        # the joined bytestreams of a scan, the i/o part of a decode
+        return self.readBytestreams(pos, len(proto))
+        
+    def decodeScan(self, proto, cnt, streams, dtype=E57_SCALED_TYPE):
+        # the compute part of a scan: one dict of field arrays, each field
+        # is its own contiguous column (structure of arrays)
+        
+        # the prototype is parsed once, then the columns are allocated 
+        # up front and filled in place
+        scan = {}
+        for spec, stream in zip(self.parsePrototype(proto, dtype), streams):
+            scan[spec.name] = np.empty(cnt, spec.dtype)
+            self.decodeField(spec, stream, cnt, scan[spec.name])
+        return scan
+        
+    def loadScan(self, scan, dtype=E57_SCALED_TYPE):
+        # read and decode one point cloud of listScans
+        streams = self.readScan(scan.prototype, scan.fileOffset)
+        return self.decodeScan(scan.prototype, scan.recordCount, streams, 
+                               dtype)
+        
+    def extractCompressedVector(self, dtype=E57_SCALED_TYPE):
+        # decode every point cloud, ScaledInteger coordinates as dtype
+        return [self.loadScan(scan, dtype) for scan in self.iterScans()]
+        
+    def adviseScan(self, fd, pos):
+        # ask the os to read the section of a scan ahead
+        if not hasattr(os, 'posix_fadvise'):
+            return
+        cv = self.readCompressedVectorSectionHeader(pos)
+        end = SegmentReader.physicalOffset(SegmentReader.logicalOffset(pos) 
+                                    + int(cv['sectionLogicalLength']))
+        os.posix_fadvise(fd, pos, end - pos, os.POSIX_FADV_WILLNEED)
+        
+    def prefetchScan(self, fd, proto, pos):
+        self.adviseScan(fd, pos)
+        return self.readScan(proto, pos)
+        
+    def streamPoints(self, dtype=E57_SCALED_TYPE):
+        # like extractCompressedVector, but yields the scans one by one;
+        # a worker reads the next scan while the current one is decoded
+        # by the kernels, which release the gil
+        scans = self.listScans()
+        if not scans:
+            return
+        fd = self._fh.fileno()
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            pending = pool.submit(self.prefetchScan, fd, *scans[0][:2])
+            for i, (proto, pos, cnt) in enumerate(scans):
+                streams = pending.result()
+                if (i+1 < len(scans)):
+                    pending = pool.submit(self.prefetchScan, fd, 
+                                          *scans[i+1][:2])
+                yield self.decodeScan(proto, cnt, streams, dtype)
+        
+    def toPoints(self, scan):
+        # (n, 3) xyz array of a decoded scan, the one interleaved copy
+        # is made here at the boundary to FreeCAD
+        return np.stack([scan['cartesianX'], 
+                         scan['cartesianY'], 
+                         scan['cartesianZ']], axis=1)
+
+
+@njit(cache=True, nogil=True)
+def wordBytes(bits):
+    # bytes one value of bits width can touch at any bit position, 
+    # beyond the first word the ninth byte is handled separately
+    return min(8, (int(bits) + 14) // 8)
+
+@njit(cache=True, nogil=True)
+def unpackValue(packed, bits, mask, nbytes, i):
+    # value i of bits width, packed lsb first; packed needs 8 bytes of 
+    # padding behind the last value
+    bit   = np.uint64(i) * bits
+    byte  = bit >> np.uint64(3)
+    shift = bit & np.uint64(7)
+    word  = np.uint64(0)
+    for k in range(nbytes):
+        word |= (np.uint64(packed[byte + np.uint64(k)]) 
+                 << np.uint64(8 * k))
+    value = word >> shift
+    if (shift + bits > np.uint64(64)):
+        # wider than 56 bits, the value reaches into a ninth byte
+        value |= (np.uint64(packed[byte + np.uint64(8)]) 
+                  << (np.uint64(64) - shift))
+    return value & mask
+
+@njit(cache=True, parallel=True, nogil=True)
+def unpackBitsLoop(packed, bits, count, out):
+    nbytes = wordBytes(bits)
+    bits = np.uint64(bits)
+    mask = np.uint64(0xFFFFFFFFFFFFFFFF) >> (np.uint64(64) - bits)
+    for i in prange(count):
+        out[i] = unpackValue(packed, bits, mask, nbytes, i)
+    return out
+
+@njit(cache=True, parallel=True, nogil=True, fastmath=True)
+def unpackScaledLoop(packed, bits, count, minimum, scale, offset, out):
+    # unpack and dequantize in one pass, the value is computed in double
+    # and only rounded once to the type of out 
+    nbytes = wordBytes(bits)
+    bits = np.uint64(bits)
+    mask = np.uint64(0xFFFFFFFFFFFFFFFF) >> (np.uint64(64) - bits)
+    for i in prange(count):
+        value = np.int64(unpackValue(packed, bits, mask, nbytes, i)) 
+        out[i] = (value + minimum) * scale + offset
+    return out
 
+_KERNELS = {}
+
+def unpackKernels(bits):
+    # unpackBitsLoop and unpackScaledLoop compiled for one width; width,
+    # mask and word size are constants of the closure, so llvm emits the
+    # fixed shift and mask sequence of that width. a file uses only a 
+    # few widths, each one is compiled once and then reused
+    kernels = _KERNELS.get(bits)
+    if kernels is not None:
+        return kernels
+    nbytes = wordBytes(bits)
+    width  = np.uint64(bits)
+    mask   = np.uint64(0xFFFFFFFFFFFFFFFF) >> np.uint64(64 - bits)
+    
+    @njit(parallel=True, nogil=True)
+    def unpackBitsFixed(packed, count, out):
+        for i in prange(count):
+            out[i] = unpackValue(packed, width, mask, nbytes, i)
+        return out
+    
+    @njit(parallel=True, nogil=True, fastmath=True)
+    def unpackScaledFixed(packed, count, minimum, scale, offset, out):
+        for i in prange(count):
+            value = np.int64(unpackValue(packed, width, mask, nbytes, i))
+            out[i] = (value + minimum) * scale + offset
+        return out
+    
+    kernels = _KERNELS[bits] = (unpackBitsFixed, unpackScaledFixed)
+    return kernels
+
+_DECODED = {}
+
+def specialize(key, count):
+    # a closure can not be cached on disk, its compile (some 0.4 s per
+    # width) only pays off after tens of millions of values; until the 
+    # values of a width add up to E57_SPECIALIZE over all calls, the 
+    # cached generic loops are used
+    decoded = _DECODED[key] = _DECODED.get(key, 0) + count
+    return (decoded >= E57_SPECIALIZE)
+
+def unpackBitsWidth(packed, bits, count, out):
+    if not specialize(('bits', bits), count):
+        return unpackBitsLoop(packed, bits, count, out)
+    return unpackKernels(bits)[0](packed, count, out)
+
+def unpackScaledWidth(packed, bits, count, minimum, scale, offset, out):
+    if not specialize(('scaled', bits), count):
+        return unpackScaledLoop(packed, bits, count, minimum, scale, offset,
+                                out)
+    return unpackKernels(bits)[1](packed, count, minimum, scale, offset, out)
+
+def unpackBitsArray(packed, bits, count, out):
+    # the same as unpackBitsLoop with numpy array operations
+    bit   = np.arange(count, dtype=np.uint64) * np.uint64(bits)
+    byte  = (bit >> np.uint64(3)).astype(np.intp)
+    shift = bit & np.uint64(7)
+    word  = np.zeros(count, np.uint64)
+    for k in range(wordBytes(bits)):
+        word |= packed[byte + k].astype(np.uint64) << np.uint64(8 * k)
+    value = word >> shift
+    if (bits > 56):
+        high = (shift + np.uint64(bits)) > 64
+        value[high] |= (packed[byte[high] + 8].astype(np.uint64) 
+                        << (np.uint64(64) - shift[high]))
+    out[:] = value & (np.uint64(0xFFFFFFFFFFFFFFFF) >> np.uint64(64 - bits))
+    return out
+
+def unpackScaledArray(packed, bits, count, minimum, scale, offset, out):
+    values = unpackBitsArray(packed, bits, count, np.empty(count, np.uint64))
+    values = values.view(np.int64) + minimum
+    out[:] = values * scale + offset
+    return out
+
+# python loops over millions of values are no option without numba
+unpackBits   = unpackBitsWidth if E57_NUMBA else unpackBitsArray
+unpackScaled = unpackScaledWidth if E57_NUMBA else unpackScaledArray
+
+
+@njit(cache=True, nogil=True)
+def gatherBuffersLoop(source, starts, lengths, targets, out):
+    # the buffers of one bytestream out of all packets, packet p writes 
+    # only its own slice of out; a plain copy loop, no parallel region,
+    # as it also runs in the prefetch thread of streamPoints while the 
+    # parallel unpack kernels run in the main thread
+    for p in range(starts.shape[0]):
+        out[targets[p]:targets[p]+lengths[p]] = (
+            source[starts[p]:starts[p]+lengths[p]])
+    return out
+
+def gatherBuffersArray(source, starts, lengths, targets, out):
+    for start, length, target in zip(starts.tolist(), lengths.tolist(), 
+                                     targets.tolist()):
+        out[target:target+length] = source[start:start+length]
+    return out
+
+gatherBuffers = gatherBuffersLoop if E57_NUMBA else gatherBuffersArray
+
+
+def crcTable():
+    table = np.arange(256, dtype=np.uint32)
+    for _ in range(8):
+        table = np.where(table & 1, (table >> 1) ^ E57_CRC_POLYNOMIAL,
+                         table >> 1).astype(np.uint32)
+    return table
+
+_CRC_TABLE = crcTable()
+
+def pageChecksums(pages):
+    # crc-32c of every row of a (pages, PageContent) block
+    if crc32c is not None:
+        return np.fromiter((crc32c(page) for page in pages), 
+                           dtype=np.uint32, count=len(pages))
+    # table driven, but one table step for all pages at once
+    crc = np.full(len(pages), 0xFFFFFFFF, dtype=np.uint32)
+    for column in pages.T:
+        crc = _CRC_TABLE[(crc ^ column) & 0xFF] ^ (crc >> 8)
+    return crc ^ np.uint32(0xFFFFFFFF)
+    
 
 class SegmentReader:
     
@@ -169,69 +648,78 @@ class SegmentReader:
     
     @classmethod
     def setPageSize(cls, ps):
-        cls.PageSize = ps
+        cls.PageSize = int(ps)
         cls.PageContent = cls.PageSize - E57_PAGE_CRC
     
-    def __init__(self, filename, offset=0, count=1):
-        self.filename  = filename
-        self.offset = offset
-        self.count  = count
+    @classmethod
+    def pageRange(cls, offset, length):
+        # closed form page layout of length logical bytes starting at the
+        # physical offset: first page, position in it and end page
+        startPage, start = divmod(int(offset), cls.PageSize)
+        endPage   = startPage + -(-(start + int(length)) // cls.PageContent)
+        return startPage, start, endPage
+    
+    @classmethod
+    def logicalOffset(cls, offset):
+        # physical file offset to the offset without crc bytes
+        page, start = divmod(int(offset), cls.PageSize)
+        return page * cls.PageContent + start
+    
+    @classmethod
+    def physicalOffset(cls, offset):
+        page, start = divmod(int(offset), cls.PageContent)
+        return page * cls.PageSize + start
+    
+    def __init__(self, source, offset=0, count=1, check=False):
+        # source is the memory map of the whole file (see E57.__init__)
+        self.source = source
+        self.offset = int(offset)
+        self.count  = int(count)
         self.setType()
         self.setSize()
-        length = self.size * count
-        real_length = length
-        self.position = self.offset
-        
-        # check position in page
-        start  = (self.position  % self.PageSize)
-        first  = np.array([(self.PageContent-start)],dtype=np.uint64)
-        diff   = (length - first[0]).astype(np.uint64)
-        if (first[0]>=length):
-            pages = [length]
+        length = self.size * self.count
+        
+        startPage, start, endPage = self.pageRange(self.offset, length)
+        pageSize    = self.PageSize
+        pageContent = self.PageContent
+        
+        if check:
+            self.checkPages(self.source, startPage, endPage)
+        if (endPage - startPage == 1):
+            # inside of one page, no crc to skip
+            content = self.source[self.offset:self.offset+length]
         else:
-            pages  = np.full((diff // self.PageSize).astype(np.uint64), 
-                    self.PageContent, np.uint64)
-            pages = np.append(first, pages)
-            modulo = (diff % self.PageSize).astype(np.uint64)
-            pages = np.append(pages,  np.array((modulo).astype(np.uint64)))
-            # correct the length because we lost with crc
-            pages[-1] = (pages[-1] + (len(pages)-2)*E57_PAGE_CRC).astype(
-                                                                    np.uint64) 
-            # maybe the last page is now to big
-            while (pages[-1] >= self.PageContent):
-                pages = np.append(pages,(pages[-1]
-                        -self.PageContent+E57_PAGE_CRC).astype(np.uint64))
-                pages[-2] = self.PageContent
-            # calc the real length
-            real_length = length + ((len(pages)-1)*E57_PAGE_CRC)
-            
-        self.position += real_length
-        self.position = int(self.position)
-        
-        # get content
-        content = bytearray()
-        offset = self.offset
-        for page in pages:
-            if (page>0):
-                if E57_DEBUG:
-                    print('Reading: ',page)
-                    content.extend(np.fromfile(self.filename, np.byte,
-                                                  count=int(page), 
-                                                  offset=offset))
-                    offset = np.sum([offset, 
-                                     page, 
-                                     E57_PAGE_CRC],
-                                     dtype=np.uint64)
+            # the enclosing pages as (pages, PageSize) block, the crc
+            # column is dropped by a single strided gather
+            raw = self.source[startPage*pageSize:endPage*pageSize]
+            content = raw.reshape(-1, pageSize)[:, :pageContent].ravel()
+            content = content[start:start+length]
+        
+        # physical position behind the last read byte
+        end = start + length
+        self.position = ((startPage + end // pageContent) * pageSize 
+                          + end % pageContent)
         
         self.result = np.frombuffer(content, dtype=self.type)
+        # single reads index fields of the one record, others columns
+        self.record = self.result[0] if self.isSingle() else self.result
         self.validate()
                                  
+    @classmethod
+    def checkPages(cls, source, startPage, endPage):
+        # compare the crc of each page with the stored big endian value
+        pageSize    = cls.PageSize
+        pageContent = cls.PageContent
+        raw = source[startPage*pageSize:endPage*pageSize]
+        raw = raw.reshape(-1, pageSize)
+        stored = raw[:, pageContent:].copy().view('>u4').ravel()
+        if not np.array_equal(pageChecksums(raw[:, :pageContent]), stored):
+            raise ValueError('Page checksum mismatch.')
+        return True
+                                 
     def setType(self):
         self.type =  np.dtype(np.byte)
         
-    def toXML(self):
-        return bytearray(self.result).decode('utf-8')
-
     def setSize(self):
         self.size = self.type.itemsize
         
@@ -239,34 +727,25 @@ class SegmentReader:
         return (self.count==1)
 
     def __getitem__(self, key):
-        if self.isSingle:
-            return self.result[key][0]
-        else:
-            return self.result[key]
+        return self.record[key]
             
     def validate(self):
         return None
 
-class E57Header(SegmentReader):
+class E57XMLReader(SegmentReader):
 
-    def setType(self):
-        self.type = np.dtype( [ ('fileSignature', np.dtype('S8')),
-        	 				 ('majorVersion', np.uint32),
-        					 ('minorVersion', np.uint32),
-        					 ('filePhysicalLength', np.uint64),
-        					 ('xmlPhysicalOffset', np.uint64),
-        					 ('xmlLogicalLength', np.uint64),
-        					 ('pageSize', np.uint64) ])
+    def toBytes(self):
+        # the gathered content is already a fresh buffer, copy it once
+        return self.result.tobytes()
+
+    def toXML(self):
+        return self.toBytes().decode('utf-8')
 
 
 class E57CompressedVectorSectionHeader(SegmentReader):
     
     def setType(self):
-        self.type = np.dtype( [ ('sectionId', np.uint8),                     
-    	                    ('reserved1', np.uint8, (7,)),
-    					    ('sectionLogicalLength', np.uint64),
-                            ('dataPhysicalOffset', np.uint64),
-                            ('indexPhysicalOffset', np.uint64) ] )
+        self.type = _CVSH_DT
                             
     def validate(self):
         if not (self['sectionId']==E57_COMPRESSED_VECTOR_SECTION):
@@ -276,10 +755,7 @@ class E57CompressedVectorSectionHeader(SegmentReader):
 class E57DataPacketHeader(SegmentReader):
     
     def setType(self):
-        self.type = np.dtype( [ ('packetType', np.uint8),
-    	                   ('packetFlags', np.uint8),
-    					   ('packetLogicalLengthMinus1', np.uint16),
-                           ('bytestreamCount', np.uint16) ] )
+        self.type = _DPH_DT
                             
     def validate(self):
         if not (self['packetType']==E57_DATA_PACKET):
@@ -289,12 +765,7 @@ class E57DataPacketHeader(SegmentReader):
 class E57IndexPacketHeader(SegmentReader):
     
     def setType(self):
-        self.type = np.dtype( [ ('packetType', np.uint8),
-    	                  ('packetFlags', np.uint8),
-    					  ('packetLogicalLengthMinus1', np.uint16),
-                          ('entryCount', np.uint16),
-                          ('indexLevel', np.uint8),
-                          ('reserved1', np.uint8, (9,))])
+        self.type = _IPH_DT
                             
     def validate(self):
         if not (self['packetType']==E57_INDEX_PACKET):
@@ -305,15 +776,14 @@ class E57IndexPacketHeader(SegmentReader):
 # test data
 #http://www.libe57.org/data.html  
 
-from pathlib import Path
+def main():
+    from pathlib import Path
     
-e57 = E57(str(Path.home())+'/Downloads/bunnyDouble.e57')
-#e57 = E57(str(Path.home())+'/Downloads/pump.e57')
-#e57 = E57(str(Path.home())+'/Downloads/garage.e57')
-
-e57.extractCompressedVector()
-
-
-
+    with E57(str(Path.home())+'/Downloads/bunnyDouble.e57') as e57:
+    #with E57(str(Path.home())+'/Downloads/pump.e57') as e57:
+    #with E57(str(Path.home())+'/Downloads/garage.e57') as e57:
+        e57.extractCompressedVector()
 
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,273 @@
+# round trip tests: files written by libE57Format (through pye57) are
+# read back with e57importer and compared to the written values
+
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC)
+import e57importer
+from e57importer import E57
+
+try:
+    import pye57.libe57 as libe57
+except ImportError:
+    libe57 = None
+
+
+INT64_MIN = -2**63
+INT64_MAX = 2**63 - 1
+
+# name: (minimum, maximum), the packed width is in the name
+INTEGER_FIELDS = {
+    'w0':  (7, 7),
+    'w1':  (0, 1),
+    'w3':  (-4, 3),
+    'w8':  (-128, 127),
+    'w11': (-1000, 1000),
+    'w16': (0, 2**16 - 1),
+    'w17': (5, 5 + 2**17 - 1),
+    'w20': (-2**19, 2**19 - 1),
+    'w32': (-2**31, 2**31 - 1),
+    'w33': (0, 2**33 - 1),
+    'w57': (-2**56, 2**56 - 1),
+    'w63': (0, INT64_MAX),
+    'w64': (INT64_MIN, INT64_MAX),
+    }
+
+# name: (minimum, maximum, scale, offset)
+SCALED_FIELDS = {
+    'cartesianX': (-50000, 70000, 0.001, 10.0),
+    'cartesianY': (-2**15, 2**15 - 1, 0.0005, -3.0),
+    'cartesianZ': (-3, 4, 0.25, 0.0),
+    }
+
+FLOAT_FIELDS = {
+    'intensity':      libe57.E57_SINGLE if libe57 else None,
+    'sphericalRange': libe57.E57_DOUBLE if libe57 else None,
+    }
+
+
+def writeE57(path, counts, seed=0):
+    # one scan per entry of counts, every scan has all the fields above;
+    # returns the written raw values of each scan
+    rng = np.random.default_rng(seed)
+    imf = libe57.ImageFile(path, 'w')
+    root = imf.root()
+    root.set('formatName', 
+             libe57.StringNode(imf, 'ASTM E57 3D Imaging Data File'))
+    root.set('guid', libe57.StringNode(imf, '{e57importer-test}'))
+    root.set('versionMajor', libe57.IntegerNode(imf, 1))
+    root.set('versionMinor', libe57.IntegerNode(imf, 0))
+    data3D = libe57.VectorNode(imf, True)
+    root.set('data3D', data3D)
+    written = []
+    for i, count in enumerate(counts):
+        scan = libe57.StructureNode(imf)
+        data3D.append(scan)
+        scan.set('guid', libe57.StringNode(imf, '{scan%d}' % i))
+        proto = libe57.StructureNode(imf)
+        values = {}
+        for name, (lo, hi) in INTEGER_FIELDS.items():
+            proto.set(name, libe57.IntegerNode(imf, lo, lo, hi))
+            values[name] = rng.integers(lo, hi, count, endpoint=True, 
+                                        dtype=np.int64)
+        for name, (lo, hi, scale, offset) in SCALED_FIELDS.items():
+            proto.set(name, libe57.ScaledIntegerNode(imf, lo, lo, hi, 
+                                                     scale, offset))
+            values[name] = rng.integers(lo, hi, count, endpoint=True, 
+                                        dtype=np.int64)
+        for name, precision in FLOAT_FIELDS.items():
+            proto.set(name, libe57.FloatNode(imf, 0.0, precision, 
+                                             0.0, 100.0))
+            values[name] = rng.uniform(0.0, 100.0, count)
+            if (precision==libe57.E57_SINGLE):
+                values[name] = values[name].astype(np.float32)
+        points = libe57.CompressedVectorNode(imf, proto, 
+                                             libe57.VectorNode(imf, True))
+        scan.set('points', points)
+        buffers = libe57.VectorSourceDestBuffer()
+        keep = []
+        for name, value in values.items():
+            if (value.dtype.kind=='i'):
+                value = np.ascontiguousarray(value, dtype=np.longlong)
+            else:
+                value = np.ascontiguousarray(value, dtype=np.float64)
+            keep.append(value)
+            buffers.append(libe57.SourceDestBuffer(imf, name, value, 
+                                                   max(count, 1), 
+                                                   True, False))
+        writer = points.writer(buffers)
+        writer.write(count)
+        writer.close()
+        written.append(values)
+    imf.close()
+    return written
+
+
+@unittest.skipIf(libe57 is None, 'pye57 is not installed')
+class RoundTripTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.path = os.path.join(cls.tmp.name, 'scans.e57')
+        # enough records for the streams to span many data packets
+        cls.written = writeE57(cls.path, [20000, 37])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def decode(self, **kwargs):
+        with E57(self.path) as e57:
+            return e57.extractCompressedVector(**kwargs)
+
+    def assertScans(self, scans, dtype=np.float32):
+        self.assertEqual(len(scans), len(self.written))
+        for scan, values in zip(scans, self.written):
+            self.assertEqual(set(scan), set(values))
+            for name in INTEGER_FIELDS:
+                np.testing.assert_array_equal(scan[name], values[name], 
+                                              err_msg=name)
+            for name, (lo, hi, scale, offset) in SCALED_FIELDS.items():
+                self.assertEqual(scan[name].dtype, dtype)
+                expected = values[name] * scale + offset
+                np.testing.assert_allclose(scan[name], expected.astype(dtype),
+                                           rtol=0, atol=1e-9, err_msg=name)
+            for name in FLOAT_FIELDS:
+                self.assertEqual(scan[name].dtype, values[name].dtype)
+                np.testing.assert_array_equal(scan[name], values[name],
+                                              err_msg=name)
+
+    def testDecode(self):
+        self.assertScans(self.decode())
+
+    def testDecodeDouble(self):
+        self.assertScans(self.decode(dtype=np.float64), np.float64)
+
+    def testIntegerTypes(self):
+        scan = self.decode()[0]
+        self.assertEqual(scan['w1'].dtype, np.uint8)
+        self.assertEqual(scan['w11'].dtype, np.int16)
+        self.assertEqual(scan['w16'].dtype, np.uint16)
+        self.assertEqual(scan['w64'].dtype, np.int64)
+
+    def testSpecializedKernels(self):
+        with mock.patch.object(e57importer, 'E57_SPECIALIZE', 0):
+            self.assertScans(self.decode())
+
+    def testArrayKernels(self):
+        # the numpy code paths used without numba
+        with mock.patch.multiple(
+                e57importer, 
+                unpackBits=e57importer.unpackBitsArray,
+                unpackScaled=e57importer.unpackScaledArray,
+                gatherBuffers=e57importer.gatherBuffersArray):
+            self.assertScans(self.decode())
+
+    def testListAndStream(self):
+        with E57(self.path) as e57:
+            scans = e57.listScans()
+            self.assertEqual([scan.recordCount for scan in scans], 
+                             [20000, 37])
+            self.assertScans([e57.loadScan(scan) for scan in scans])
+            self.assertScans(list(e57.streamPoints()))
+
+    def testEmptyScan(self):
+        # a scan without records is written as one data packet without
+        # bytestreams, it must not stop the other scans from decoding
+        path = os.path.join(self.tmp.name, 'empty.e57')
+        written = writeE57(path, [0, 14])
+        with E57(path) as e57:
+            scans = e57.extractCompressedVector()
+            self.assertEqual([scan.recordCount for scan in e57.listScans()],
+                             [0, 14])
+        self.assertEqual([len(scan['w11']) for scan in scans], [0, 14])
+        for name in INTEGER_FIELDS:
+            np.testing.assert_array_equal(scans[1][name], written[1][name])
+
+    @unittest.skipIf(not e57importer.E57_NUMBA, 'numba is not installed')
+    def testStreamWorkqueue(self):
+        # the prefetch thread runs while the parallel kernels decode; the 
+        # workqueue layer, the one left without tbb/openmp, aborts the 
+        # process if both threads launch parallel regions
+        counts = [200000] * 4
+        path = os.path.join(self.tmp.name, 'stream.e57')
+        writeE57(path, counts)
+        script = ('import sys; sys.path.insert(0, %r)\n'
+                  'import e57importer\n'
+                  'with e57importer.E57(%r) as e57:\n'
+                  '    print(sum(len(scan["w11"]) '
+                  'for scan in e57.streamPoints()))\n') % (SRC, path)
+        env = dict(os.environ, NUMBA_THREADING_LAYER='workqueue',
+                   NUMBA_NUM_THREADS='4')
+        result = subprocess.run([sys.executable, '-c', script], env=env,
+                                capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.split()[-1], str(sum(counts)))
+
+    def testShortStream(self):
+        # a recordCount beyond the stored values is refused before the
+        # unchecked kernels read past the streams
+        with E57(self.path) as e57:
+            scan = e57.listScans()[1]
+            with self.assertRaises(ValueError):
+                e57.loadScan(scan._replace(recordCount=50000000))
+            specs = e57.parsePrototype(scan.prototype)
+            streams = e57.readScan(scan.prototype, scan.fileOffset)
+            for spec, stream in zip(specs, streams):
+                if (spec.kind=='Float' or spec.bits==0):
+                    continue
+                with self.assertRaises(ValueError, msg=spec.name):
+                    e57.decodeField(spec, stream, 50000000)
+
+    def testCheckPages(self):
+        with E57(self.path) as e57:
+            self.assertTrue(e57.checkPages())
+
+    def testCorruptPage(self):
+        with open(self.path, 'rb') as fh:
+            data = bytearray(fh.read())
+        # a byte of the first data page, behind the header page
+        data[1024 + 100] ^= 0xFF
+        path = os.path.join(self.tmp.name, 'corrupt.e57')
+        with open(path, 'wb') as fh:
+            fh.write(data)
+        with E57(path, checkfile=True) as e57:
+            with self.assertRaises(ValueError):
+                e57.extractCompressedVector()
+            with self.assertRaises(ValueError):
+                e57.checkPages()
+
+
+class SpecializeTest(unittest.TestCase):
+
+    def testCountsOverCalls(self):
+        # a width is only specialized once its values add up over calls
+        with mock.patch.multiple(e57importer, E57_SPECIALIZE=1000,
+                                 _DECODED={}):
+            self.assertFalse(e57importer.specialize(('bits', 17), 600))
+            self.assertFalse(e57importer.specialize(('bits', 11), 600))
+            self.assertTrue(e57importer.specialize(('bits', 17), 600))
+
+
+class MalformedFileTest(unittest.TestCase):
+
+    def testShortFile(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'short.e57')
+            with open(path, 'wb') as fh:
+                fh.write(b'ASTM-E57' + bytes(20))
+            with self.assertRaises(ValueError):
+                E57(path)
+
+
+if __name__ == '__main__':
+    unittest.main()